@@ -0,0 +1,72 @@
+'''
+Copyright (C) 2017-2022 Bryant Moscon - bmoscon@gmail.com
+
+Please see the LICENSE file for the terms and conditions
+associated with this software.
+'''
+from decimal import Decimal
+
+
+cdef object _Decimal = Decimal
+
+
+def apply_delta(object book_side, list updates, list delta_out):
+    """
+    Apply a list of [price, amount] string pairs to one side of a book.
+    Levels with a zero amount are removed, all others are inserted or replaced.
+    Every level that modified the book is appended to delta_out as (price, amount)
+    """
+    cdef list update
+    cdef object price
+    cdef object amount
+
+    for update in updates:
+        price = _Decimal(update[0])
+        amount = _Decimal(update[1])
+
+        if not amount:
+            if price in book_side:
+                del book_side[price]
+                delta_out.append((price, amount))
+        else:
+            book_side[price] = amount
+            delta_out.append((price, amount))
+
+
+def snapshot_side(list entries):
+    """
+    Convert a list of [price, amount] string pairs into a {price: amount} dict of Decimals
+    """
+    cdef dict ret = {}
+
+    for price, amount in entries:
+        ret[_Decimal(price)] = _Decimal(amount)
+    return ret
+
+
+cdef enum:
+    _SKIP = 0
+    _APPLY = 1
+    _GAP = 2
+
+
+SKIP = _SKIP
+APPLY = _APPLY
+GAP = _GAP
+
+
+cpdef int check_update_id(long long first_id, long long last_id, long long last_update_id, bint synced):
+    """
+    Validate an update spanning first_id..last_id against the last applied update id.
+    Until the book is synced the first update may overlap the snapshot, after that
+    every update must start immediately after the previous one.
+    Returns SKIP (stale update), APPLY or GAP (updates were missed)
+    """
+    if not synced:
+        if last_id <= last_update_id:
+            return _SKIP
+        if first_id <= last_update_id + 1 <= last_id:
+            return _APPLY
+    elif last_update_id + 1 == first_id:
+        return _APPLY
+    return _GAP
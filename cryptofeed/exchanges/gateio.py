@@ -4,7 +4,9 @@ Copyright (C) 2017-2022 Bryant Moscon - bmoscon@gmail.com
 Please see the LICENSE file for the terms and conditions
 associated with this software.
 '''
-from collections import defaultdict
+import asyncio
+from collections import deque
+import functools
 import logging
 from decimal import Decimal
 import time
@@ -14,6 +16,7 @@ from yapic import json
 
 from cryptofeed.connection import AsyncConnection, RestEndpoint, Routes, WebsocketEndpoint
 from cryptofeed.defines import BID, ASK, CANDLES, GATEIO, L2_BOOK, TICKER, TRADES, BUY, SELL
+from cryptofeed.exchanges._gateio_book import APPLY, GAP, apply_delta, check_update_id, snapshot_side
 from cryptofeed.feed import Feed
 from cryptofeed.symbols import Symbol
 from cryptofeed.types import OrderBook, Trade, Ticker, Candle
@@ -29,6 +32,8 @@ class Gateio(Feed):
     rest_endpoints = [RestEndpoint('https://api.gateio.ws', routes=Routes('/api/v4/spot/currency_pairs', l2book='/api/v4/spot/order_book?currency_pair={}&limit=100&with_id=true'))]
 
     valid_candle_intervals = {'10s', '1m', '5m', '15m', '30m', '1h', '4h', '8h', '1d', '3d'}
+    # '7d' candles are normalized to '1w'
+    _candle_interval_seconds = {interval: timedelta_str_to_sec(interval) for interval in valid_candle_intervals | {'1w'}}
     websocket_channels = {
         L2_BOOK: 'spot.order_book_update',
         TRADES: 'spot.trades',
@@ -49,10 +54,27 @@ class Gateio(Feed):
             info['instrument_type'][s.normalized] = s.type
         return ret, info
 
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._pending_snapshot = {}
+        self._snapshot_tasks = set()
+        self._reset()
+
     def _reset(self):
+        for task in self._pending_snapshot.values():
+            task.cancel()
+        self._pending_snapshot = {}
+        self._snapshot_errors = {}
+        self._delta_buffer = {}
         self._l2_book = {}
         self.last_update_id = {}
-        self.forced = defaultdict(bool)
+        self._synced_pairs = set()
+        self._dispatch = {
+            self.websocket_channels[TICKER]: self._ticker,
+            self.websocket_channels[TRADES]: self._trades,
+            self.websocket_channels[L2_BOOK]: self._process_l2_book,
+            self.websocket_channels[CANDLES]: self._candles
+        }
 
     async def _ticker(self, msg: dict, timestamp: float):
         """
@@ -73,11 +95,12 @@ class Gateio(Feed):
             }
         }
         """
+        result = msg['result']
         t = Ticker(
             self.id,
-            self.exchange_symbol_to_std_symbol(msg['result']['currency_pair']),
-            Decimal(msg['result']['highest_bid']),
-            Decimal(msg['result']['lowest_ask']),
+            self.exchange_symbol_to_std_symbol(result['currency_pair']),
+            Decimal(result['highest_bid']),
+            Decimal(result['lowest_ask']),
             float(msg['time']),
             raw=msg
         )
@@ -100,14 +123,15 @@ class Gateio(Feed):
             }
         }
         """
+        result = msg['result']
         t = Trade(
             self.id,
-            self.exchange_symbol_to_std_symbol(msg['result']['currency_pair']),
-            SELL if msg['result']['side'] == 'sell' else BUY,
-            Decimal(msg['result']['amount']),
-            Decimal(msg['result']['price']),
-            float(msg['result']['create_time_ms']) / 1000,
-            id=str(msg['result']['id']),
+            self.exchange_symbol_to_std_symbol(result['currency_pair']),
+            SELL if result['side'] == 'sell' else BUY,
+            Decimal(result['amount']),
+            Decimal(result['price']),
+            float(result['create_time_ms']) / 1000,
+            id=str(result['id']),
             raw=msg
         )
         await self.callback(TRADES, t, timestamp)
@@ -121,32 +145,49 @@ class Gateio(Feed):
         }
         """
         ret = await self.http_conn.read(self.rest_endpoints[0].route('l2book', self.sandbox).format(symbol))
-        data = json.loads(ret, parse_float=Decimal)
-
         symbol = self.exchange_symbol_to_std_symbol(symbol)
-        self._l2_book[symbol] = OrderBook(self.id, symbol, max_depth=self.max_depth)
+        # only the REST request may be cancelled by a reset, from here on the
+        # task runs callbacks and checks for resets itself
+        del self._pending_snapshot[symbol]
+        buffer = self._delta_buffer[symbol]
+        data = json.loads(ret)
+
+        book = OrderBook(self.id, symbol, max_depth=self.max_depth, bids=snapshot_side(data['bids']), asks=snapshot_side(data['asks']))
+        self._l2_book[symbol] = book
         self.last_update_id[symbol] = data['id']
-        self._l2_book[symbol].book.bids = {Decimal(price): Decimal(amount) for price, amount in data['bids']}
-        self._l2_book[symbol].book.asks = {Decimal(price): Decimal(amount) for price, amount in data['asks']}
-        await self.book_callback(L2_BOOK, self._l2_book[symbol], time.time(), raw=data, sequence_number=data['id'])
+        await self.book_callback(L2_BOOK, book, time.time(), raw=data, sequence_number=data['id'])
 
-    def _check_update_id(self, pair: str, msg: dict) -> Tuple[bool, bool]:
-        skip_update = False
-        forced = not self.forced[pair]
+        # replay the updates buffered while the snapshot was in flight. Updates that
+        # arrive during the replay are appended to the same buffer, so order is kept.
+        # If the book is reset meanwhile, the next update requests a new snapshot
+        while self._l2_book.get(symbol) is book and buffer:
+            msg, timestamp = buffer.popleft()
+            await self._apply_l2_update(symbol, msg, timestamp)
+        if self._l2_book.get(symbol) is book:
+            del self._delta_buffer[symbol]
 
-        if forced and msg['u'] <= self.last_update_id[pair]:
-            skip_update = True
-        elif forced and msg['U'] <= self.last_update_id[pair] + 1 <= msg['u']:
-            self.last_update_id[pair] = msg['u']
-            self.forced[pair] = True
-        elif not forced and self.last_update_id[pair] + 1 == msg['U']:
+    def _snapshot_done(self, symbol: str, buffer: deque, task: asyncio.Task):
+        self._snapshot_tasks.discard(task)
+        if task.cancelled() or task.exception() is None:
+            return
+        if self._pending_snapshot.get(symbol) is task:
+            del self._pending_snapshot[symbol]
+        if self._delta_buffer.get(symbol) is buffer:
+            # stop buffering, the error is raised from the symbol's next update
+            del self._delta_buffer[symbol]
+            self._snapshot_errors[symbol] = task.exception()
+
+    def _check_update_id(self, pair: str, msg: dict) -> bool:
+        status = check_update_id(msg['U'], msg['u'], self.last_update_id[pair], pair in self._synced_pairs)
+
+        if status == APPLY:
             self.last_update_id[pair] = msg['u']
-        else:
+            self._synced_pairs.add(pair)
+            return False
+        if status == GAP:
             self._reset()
             LOG.warning("%s: Missing book update detected, resetting book", self.id)
-            skip_update = True
-
-        return skip_update
+        return True
 
     async def _process_l2_book(self, msg: dict, timestamp: float):
         """
@@ -166,31 +207,45 @@ class Gateio(Feed):
             }
         }
         """
-        symbol = self.exchange_symbol_to_std_symbol(msg['result']['s'])
+        result = msg['result']
+        symbol = self.exchange_symbol_to_std_symbol(result['s'])
+        if self._snapshot_errors and symbol in self._snapshot_errors:
+            # surface a failed snapshot to the connection handler, as if raised inline
+            raise self._snapshot_errors.pop(symbol)
+        if symbol in self._delta_buffer:
+            self._delta_buffer[symbol].append((msg, timestamp))
+            return
         if symbol not in self._l2_book:
-            await self._snapshot(msg['result']['s'])
-
-        skip_update = self._check_update_id(symbol, msg['result'])
-        if skip_update:
+            # fetch the snapshot in the background so other symbols on this
+            # connection are not blocked behind the REST request
+            buffer = deque(((msg, timestamp),))
+            self._delta_buffer[symbol] = buffer
+            task = asyncio.create_task(self._snapshot(result['s']))
+            task.add_done_callback(functools.partial(self._snapshot_done, symbol, buffer))
+            self._pending_snapshot[symbol] = task
+            self._snapshot_tasks.add(task)
+            # let the snapshot request start before the next message is handled
+            await asyncio.sleep(0)
             return
 
-        ts = msg['result']['t'] / 1000
-        delta = {BID: [], ASK: []}
+        await self._apply_l2_update(symbol, msg, timestamp)
 
-        for s, side in (('b', BID), ('a', ASK)):
-            for update in msg['result'][s]:
-                price = Decimal(update[0])
-                amount = Decimal(update[1])
+    async def _apply_l2_update(self, symbol: str, msg: dict, timestamp: float):
+        result = msg['result']
+        book = self._l2_book[symbol]
+
+        skip_update = self._check_update_id(symbol, result)
+        if skip_update:
+            return
 
-                if amount == 0:
-                    if price in self._l2_book[symbol].book[side]:
-                        del self._l2_book[symbol].book[side][price]
-                        delta[side].append((price, amount))
-                else:
-                    self._l2_book[symbol].book[side][price] = amount
-                    delta[side].append((price, amount))
+        ts = result['t'] / 1000
+        bid_delta = []
+        ask_delta = []
+        apply_delta(book.book.bids, result['b'], bid_delta)
+        apply_delta(book.book.asks, result['a'], ask_delta)
+        delta = {BID: bid_delta, ASK: ask_delta}
 
-        await self.book_callback(L2_BOOK, self._l2_book[symbol], timestamp, delta=delta, timestamp=ts, raw=msg)
+        await self.book_callback(L2_BOOK, book, timestamp, delta=delta, timestamp=ts, raw=msg)
 
     async def _candles(self, msg: dict, timestamp: float):
         """
@@ -209,21 +264,23 @@ class Gateio(Feed):
             }
         }
         """
-        interval, symbol = msg['result']['n'].split('_', 1)
+        result = msg['result']
+        interval, symbol = result['n'].split('_', 1)
         if interval == '7d':
             interval = '1w'
+        start = float(result['t'])
         c = Candle(
             self.id,
             self.exchange_symbol_to_std_symbol(symbol),
-            float(msg['result']['t']),
-            float(msg['result']['t']) + timedelta_str_to_sec(interval) - 0.1,
+            start,
+            start + self._candle_interval_seconds[interval] - 0.1,
             interval,
             None,
-            Decimal(msg['result']['o']),
-            Decimal(msg['result']['c']),
-            Decimal(msg['result']['h']),
-            Decimal(msg['result']['l']),
-            Decimal(msg['result']['v']),
+            Decimal(result['o']),
+            Decimal(result['c']),
+            Decimal(result['h']),
+            Decimal(result['l']),
+            Decimal(result['v']),
             None,
             float(msg['time']),
             raw=msg
@@ -231,49 +288,45 @@ class Gateio(Feed):
         await self.callback(CANDLES, c, timestamp)
 
     async def message_handler(self, msg: str, conn, timestamp: float):
-        msg = json.loads(msg, parse_float=Decimal)
+        # successful subscribe acks carry no data, skip them without decoding
+        if msg.find('"event":"subscribe"', 0, 128) != -1 and '"status":"success"' in msg:
+            return
 
-        if "error" in msg:
-            if msg['error'] is None:
-                pass
-            else:
-                LOG.warning("%s: Error received from exchange - %s", self.id, msg)
+        msg = json.loads(msg)
+
+        if msg.get('error'):
+            LOG.warning("%s: Error received from exchange - %s", self.id, msg)
         if msg['event'] == 'subscribe':
             return
         elif 'channel' in msg:
-            market, channel = msg['channel'].split('.')
-            if channel == 'tickers':
-                await self._ticker(msg, timestamp)
-            elif channel == 'trades':
-                await self._trades(msg, timestamp)
-            elif channel == 'order_book_update':
-                await self._process_l2_book(msg, timestamp)
-            elif channel == 'candlesticks':
-                await self._candles(msg, timestamp)
+            handler = self._dispatch.get(msg['channel'])
+            if handler:
+                await handler(msg, timestamp)
             else:
                 LOG.warning("%s: Unhandled message type %s", self.id, msg)
         else:
             LOG.warning("%s: Invalid message type %s", self.id, msg)
 
+    async def shutdown(self):
+        for task in self._snapshot_tasks:
+            task.cancel()
+        await super().shutdown()
+
     async def subscribe(self, conn: AsyncConnection):
         self._reset()
+        now = int(time.time())
         for chan in self.subscription:
             symbols = self.subscription[chan]
             nchan = self.exchange_channel_to_std(chan)
             if nchan in {L2_BOOK, CANDLES}:
+                msg = {"time": now, "channel": chan, "event": 'subscribe'}
                 for symbol in symbols:
-                    await conn.write(json.dumps(
-                        {
-                            "time": int(time.time()),
-                            "channel": chan,
-                            "event": 'subscribe',
-                            "payload": [symbol, '100ms'] if nchan == L2_BOOK else [self.candle_interval, symbol],
-                        }
-                    ))
+                    msg["payload"] = [symbol, '100ms'] if nchan == L2_BOOK else [self.candle_interval, symbol]
+                    await conn.write(json.dumps(msg))
             else:
                 await conn.write(json.dumps(
                     {
-                        "time": int(time.time()),
+                        "time": now,
                         "channel": chan,
                         "event": 'subscribe',
                         "payload": symbols,
@@ -7,6 +7,8 @@ associated with this software.
 
 
 def timedelta_str_to_sec(td: str):
+    if td == '10s':
+        return 10
     if td == '1m':
         return 60
     if td == '3m':
@@ -42,10 +42,12 @@ define_macros.append(('CYTHON_WITHOUT_ASSERTIONS', None))
 extension = Extension("cryptofeed.types", ["cryptofeed/types.pyx"],
                       extra_compile_args=extra_compile_args,
                       define_macros=define_macros)
+gateio_book = Extension("cryptofeed.exchanges._gateio_book", ["cryptofeed/exchanges/_gateio_book.pyx"],
+                        extra_compile_args=extra_compile_args)
 
 setup(
     name="cryptofeed",
-    ext_modules=cythonize([extension], language_level=3, force=True),
+    ext_modules=cythonize([extension, gateio_book], language_level=3, force=True),
     version="2.2.2",
     author="Bryant Moscon",
     author_email="bmoscon@gmail.com",
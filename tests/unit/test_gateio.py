@@ -0,0 +1,130 @@
+'''
+Copyright (C) 2017-2022 Bryant Moscon - bmoscon@gmail.com
+
+Please see the LICENSE file for the terms and conditions
+associated with this software.
+'''
+import asyncio
+from decimal import Decimal
+
+import pytest
+from yapic import json
+
+from cryptofeed.defines import BID, L2_BOOK
+from cryptofeed.exchanges import Gateio
+from cryptofeed.exchanges._gateio_book import APPLY, GAP, SKIP, apply_delta, check_update_id, snapshot_side
+from cryptofeed.symbols import Symbols
+
+
+def test_apply_delta():
+    side = {Decimal('1.1'): Decimal('2'), Decimal('1.2'): Decimal('3')}
+    delta = []
+
+    apply_delta(side, [['1.1', '0'], ['1.3', '0'], ['1.2', '4.5'], ['1.4', '1']], delta)
+
+    assert side == {Decimal('1.2'): Decimal('4.5'), Decimal('1.4'): Decimal('1')}
+    assert delta == [(Decimal('1.1'), Decimal('0')), (Decimal('1.2'), Decimal('4.5')), (Decimal('1.4'), Decimal('1'))]
+
+
+def test_apply_delta_malformed_level():
+    with pytest.raises(IndexError):
+        apply_delta({}, [['1']], [])
+
+
+def test_snapshot_side():
+    assert snapshot_side([['1.1', '2'], ['1.2', '0.5']]) == {Decimal('1.1'): Decimal('2'), Decimal('1.2'): Decimal('0.5')}
+    assert snapshot_side([]) == {}
+
+    with pytest.raises(ValueError):
+        snapshot_side([['1']])
+
+
+def test_check_update_id():
+    # first update after the snapshot may overlap it
+    assert check_update_id(90, 100, 100, False) == SKIP
+    assert check_update_id(95, 105, 100, False) == APPLY
+    assert check_update_id(102, 105, 100, False) == GAP
+    # once synced updates must be contiguous
+    assert check_update_id(101, 110, 100, True) == APPLY
+    assert check_update_id(102, 110, 100, True) == GAP
+
+
+def _book_update(first_id, last_id, bids, pair='BTC_USDT'):
+    return json.dumps({
+        'time': 1, 'channel': 'spot.order_book_update', 'event': 'update',
+        'result': {'t': 1000, 's': pair, 'U': first_id, 'u': last_id, 'b': bids, 'a': []}
+    })
+
+
+def test_book_updates_buffered_during_snapshot():
+    Symbols.clear()
+    Symbols.set(Gateio.id, {'BTC-USDT': 'BTC_USDT'}, {'instrument_type': {}})
+    books = []
+
+    async def book_cb(book, receipt_timestamp):
+        books.append((book.sequence_number, book.delta, book.book.bids.to_dict()))
+
+    async def snapshot(*args, **kwargs):
+        await asyncio.sleep(0.01)
+        return json.dumps({'id': 100, 'bids': [['1', '1']], 'asks': [['2', '1']]})
+
+    async def run():
+        feed = Gateio(symbols=['BTC-USDT'], channels=[L2_BOOK], callbacks={L2_BOOK: book_cb})
+        feed.http_conn.read = snapshot
+        await feed.message_handler(_book_update(95, 101, [['1', '2']]), None, 1.0)
+        await feed.message_handler(_book_update(102, 103, [['0.5', '3']]), None, 1.0)
+        assert books == []
+        await asyncio.sleep(0.05)
+        await feed.shutdown()
+
+    asyncio.run(run())
+    Symbols.clear()
+
+    assert [sequence_number for sequence_number, _, _ in books] == [100, None, None]
+    assert books[1][1][BID] == [(Decimal('1'), Decimal('2'))]
+    assert books[2][2] == {Decimal('1'): Decimal('2'), Decimal('0.5'): Decimal('3')}
+
+
+def test_book_snapshot_failure():
+    Symbols.clear()
+    Symbols.set(Gateio.id, {'BTC-USDT': 'BTC_USDT', 'ETH-USDT': 'ETH_USDT'}, {'instrument_type': {}})
+    books = []
+
+    async def book_cb(book, receipt_timestamp):
+        books.append(book.symbol)
+
+    async def snapshot(url, **kwargs):
+        await asyncio.sleep(0.01)
+        if 'BTC_USDT' in url:
+            raise RuntimeError('snapshot failed')
+        return json.dumps({'id': 100, 'bids': [['1', '1']], 'asks': [['2', '1']]})
+
+    async def run():
+        feed = Gateio(symbols=['BTC-USDT', 'ETH-USDT'], channels=[L2_BOOK], callbacks={L2_BOOK: book_cb})
+        feed.http_conn.read = snapshot
+        await feed.message_handler(_book_update(95, 101, []), None, 1.0)
+        await feed.message_handler(_book_update(95, 101, [], pair='ETH_USDT'), None, 1.0)
+        await asyncio.sleep(0.05)
+        assert 'BTC-USDT' not in feed._pending_snapshot
+        assert 'BTC-USDT' not in feed._delta_buffer
+
+        # other symbols are unaffected, the error is raised from the failed symbol's update
+        await feed.message_handler(_book_update(102, 102, [], pair='ETH_USDT'), None, 1.0)
+        with pytest.raises(RuntimeError):
+            await feed.message_handler(_book_update(102, 102, []), None, 1.0)
+
+        # the next update starts a fresh snapshot
+        await feed.message_handler(_book_update(103, 103, []), None, 1.0)
+        assert 'BTC-USDT' in feed._pending_snapshot
+
+        # a reset drops errors that were not raised yet
+        await asyncio.sleep(0.05)
+        assert 'BTC-USDT' in feed._snapshot_errors
+        feed._reset()
+        assert feed._snapshot_errors == {}
+        await feed.shutdown()
+
+    asyncio.run(run())
+    Symbols.clear()
+
+    assert books == ['ETH-USDT', 'ETH-USDT', 'ETH-USDT']
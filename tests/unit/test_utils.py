@@ -6,6 +6,7 @@ associated with this software.
 '''
 from cryptofeed.defines import BID, ASK
 from cryptofeed.util.book import book_delta
+from cryptofeed.util.time import timedelta_str_to_sec
 
 
 def test_book_delta_simple():
@@ -55,3 +56,7 @@ def test_book_delta_empty():
 
     assert book_delta(a, b) == {'bid': [(0.9, 0), (1.0, 0), (0.8, 0)], 'ask': [(1.2, 0), (1.1, 0), (1.3, 0)]}
     assert book_delta(b, a) == {'ask': [(1.2, 0.6), (1.1, 1.1), (1.3, 2.1)], 'bid': [(0.9, 0.5), (1.0, 1), (0.8, 2)]}
+
+
+def test_timedelta_str_to_sec():
+    assert timedelta_str_to_sec('10s') == 10